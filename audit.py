@@ -1,14 +1,31 @@
 from clients import GoogleAdminClient, GoogleDriveClient
 from external import csv_utils
 from datetime import datetime
+import itertools
 import logging
+import os
 import sys
 import json
 import time
+import threading
+from Queue import PriorityQueue
 from logging import Handler
 
 logger = logging.getLogger(__name__)
 
+# Report profiles.
+# A full audit walks every folder in every drive.
+FULL_AUDIT = "full_audit"
+# A risk scan only lists externally exposed files, with the filters pushed into the drive query.
+RISK_SCAN = "risk_scan"
+
+# User queue tasks and their fixed priorities (lower runs first, audits are prioritized by -drive size).
+_PROBE_TASK = "probe"
+_AUDIT_TASK = "audit"
+_FOLDER_TASK = "folder"
+_PROBE_PRIORITY = float("-inf")
+_SENTINEL_PRIORITY = float("inf")
+
 def _dt_fmt(dt):
     if not isinstance(dt, datetime):
         return dt
@@ -29,16 +46,40 @@ def enable_stdout_logging():
     root.addHandler(handler)
 
 
+class _UserDriveWalk(object):
+    """
+    Progress of a user drive walk which is split into folder tasks across workers.
+    """
+
+    def __init__(self, user, estimated_size=None):
+        self.user = user
+        self.estimated_size = estimated_size
+        self.started = time.time()
+        # Files found so far as [path, gdrive_file] pairs.
+        self.files = []
+        # Number of folders listed or queued but not yet finished.
+        self.pending = 1
+        # Set when listing any folder fails.
+        self.failed = False
+        self.lock = threading.Lock()
+        # Drive client connected as the user, shared by every worker walking this drive.
+        self.drive_client = None
+
+
 class GoogleDriveAuditReport(object):
     """
     Reporting utility that generates a local spreadsheet of GDrive files and permissions.
     Usage is simple but the utility can take a while to run, see example usage below:
     """
 
-    def __init__(self, credentials, admin_user, audit_users=True, audit_team_drives=False):
+    def __init__(self, credentials, admin_user, audit_users=True, audit_team_drives=False, profile=FULL_AUDIT):
         self.should_audit_users = audit_users
         self.should_audit_drives = audit_team_drives
 
+        if profile not in (FULL_AUDIT, RISK_SCAN):
+            raise ValueError("'profile' must be one of '%s' or '%s'." % (FULL_AUDIT, RISK_SCAN))
+        self.profile = profile
+
         if not isinstance(credentials, basestring):
             raise ValueError("'credentials' must be a json formatted credential string, "
                              "or a filename pointing to a json formatted credential string.")
@@ -64,6 +105,31 @@ class GoogleDriveAuditReport(object):
         # To add exclusion folders, set this property before starting the report.
         self.exclude_folders_named = [".git"]
 
+        # Number of user drives walked concurrently while the user directory is still being listed.
+        self.worker_count = 4
+        # Set these to skip suspended or archived accounts when listing users.
+        self.exclude_suspended_users = False
+        self.exclude_archived_users = False
+        # Set when the user directory listing fails part way, the audited users are then incomplete.
+        self.user_listing_failed = False
+        self._user_files_lock = threading.Lock()
+
+        # File counts from the previous full audit are kept here to schedule the largest drives first.
+        # Set to None to disable.
+        self.drive_size_file = "user_drive_sizes.json"
+        # Estimate drives missing from the previous run with a single listing page before scheduling them.
+        self.probe_unknown_drive_sizes = False
+        # Per-user file count, seconds taken and estimated size of the last run.
+        self.user_audit_stats = dict()
+
+        # Risk scan filters, set these before starting a RISK_SCAN report.
+        # Files matching any of the visibility values or shared with any of the listed emails are reported.
+        self.risk_visibility = ["anyoneWithLink", "anyoneCanFind"]
+        self.risk_shared_with = []
+        # Optional last modified date range (datetime) for risk scans.
+        self.modified_after = None
+        self.modified_before = None
+
     def start(self, output_file_name=None):
         """
         Start generating the report.
@@ -72,7 +138,9 @@ class GoogleDriveAuditReport(object):
         self.audit_users()
         self.audit_team_drives()
 
-        if self.should_audit_users:
+        if self.should_audit_users and self.user_listing_failed:
+            logger.error("Skipping user drive report export, the user listing failed and the report would be partial.")
+        elif self.should_audit_users:
             self.export_user_drive_report(output_file_name)
 
         if self.should_audit_drives:
@@ -112,39 +180,240 @@ class GoogleDriveAuditReport(object):
     def audit_users(self):
         """
         Audit all files found in user drives.
+        User pages are fed to a pool of workers as they arrive, so drive walks overlap with the directory listing.
+        Queued users are picked up largest drive first, using sizes recorded by the previous run.
         :return:
         """
         if not self.should_audit_users:
             logger.info("Skipping audit of user drives.")
             return
 
+        if self.profile == RISK_SCAN:
+            self.validate_risk_scan()
+
         logger.info("Beginning google drive audit of user drives.")
-        users = self.get_users()
+        http_pool = GoogleDriveClient.http_pool
+        if http_pool.pool_size < self.worker_count + 1:
+            # The pool is shared by every client in the process, so its size is left to the caller.
+            logger.warning("HTTP pool size %i is below worker_count + 1 (%i), workers will wait for connections.",
+                           http_pool.pool_size, self.worker_count + 1)
+        drive_sizes = self.load_drive_sizes()
+        user_queue = PriorityQueue()
+        sequence = itertools.count()
+        workers = [threading.Thread(target=self._audit_user_queue, args=(user_queue, sequence))
+                   for _ in xrange(max(1, self.worker_count))]
+        started = time.time()
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        for users in self.user_pages():
+            for user in users:
+                if not user.primaryEmail:
+                    continue
+                size = drive_sizes.get(user.primaryEmail)
+                if size is None and self.probe_unknown_drive_sizes:
+                    # Probes are cheap, run them ahead of any drive walk.
+                    user_queue.put((_PROBE_PRIORITY, next(sequence), _PROBE_TASK, user))
+                else:
+                    # Largest drives first (longest processing time scheduling), unknown sizes last.
+                    user_queue.put((-(size or 0), next(sequence), _AUDIT_TASK, (user, size)))
+
+        # Wait for every queued task, including folders queued by workers, before stopping the workers.
+        # Python 2 can't interrupt an untimed join, so wait in short intervals to let Ctrl-C stop the run.
+        with user_queue.all_tasks_done:
+            while user_queue.unfinished_tasks:
+                user_queue.all_tasks_done.wait(1.0)
+        # One sentinel per worker signals the end of the audit.
+        for _ in workers:
+            user_queue.put((_SENTINEL_PRIORITY, next(sequence), None, None))
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(1.0)
+
+        self.log_user_audit_stats(time.time() - started)
+        logger.info("HTTP connection stats: %s.", http_pool.connection_stats)
+        if self.user_listing_failed:
+            logger.error("User listing failed, only %i user drives were audited.", len(self.user_audit_stats))
+            return
+        if self.profile == FULL_AUDIT:
+            # Only full audits count every file in a drive.
+            for email, stats in self.user_audit_stats.iteritems():
+                if stats["files"] is not None:
+                    drive_sizes[email] = stats["files"]
+            self.save_drive_sizes(drive_sizes)
+
+    def _audit_user_queue(self, user_queue, sequence):
+        """
+        Worker loop, run queued user and folder tasks until a sentinel is received.
+        """
+        while True:
+            priority, _, task, item = user_queue.get()
+            try:
+                if task is None:
+                    return
+                if task == _PROBE_TASK:
+                    # Re-queue the user now that its drive size is estimated.
+                    size = self.probe_drive_size(item)
+                    user_queue.put((-(size or 0), next(sequence), _AUDIT_TASK, (item, size)))
+                elif task == _FOLDER_TASK:
+                    self.walk_user_folder(item, priority, user_queue, sequence)
+                elif self.profile == FULL_AUDIT:
+                    # Walk the root folder now, its subfolders are queued for any worker to pick up.
+                    user, estimated_size = item
+                    walk = _UserDriveWalk(user, estimated_size=estimated_size)
+                    self.walk_user_folder((walk, 'root', None, 0), priority, user_queue, sequence)
+                else:
+                    user, estimated_size = item
+                    self.scan_user(user, estimated_size=estimated_size)
+            finally:
+                user_queue.task_done()
+
+    def walk_user_folder(self, folder_item, priority, user_queue, sequence):
+        """
+        List one folder of a user's drive and queue its subfolders as separate tasks,
+        so a single large drive can be walked by all workers at once.
+
+        :param folder_item: tuple of (user drive walk, folder id, path, depth)
+        :param priority: queue priority of the user's drive, shared by all of its folders
+        :param user_queue: queue to add subfolder tasks to
+        :param sequence: task sequence counter
+        """
+        walk, folder_id, path, depth = folder_item
+        files, subfolders = [], []
+        try:
+            if not walk.drive_client:
+                # Only the root folder is listed before any subfolders are queued, so this runs in one worker.
+                walk.drive_client = GoogleDriveClient(self.credentials, connect_as=walk.user.primaryEmail)
+            # Strict, so a failed request fails the walk rather than leaving out the folder's contents.
+            files, subfolders = walk.drive_client.list_folder(folder_id=folder_id, path=path, depth=depth,
+                                                         exclude_folders_named=self.exclude_folders_named,
+                                                         strict=True)
+        except:
+            logger.exception("Error occurred querying drive files for user %s.", walk.user.primaryEmail)
+            walk.failed = True
+
+        with walk.lock:
+            walk.files.extend(files)
+            # This folder is finished, its subfolders are pending.
+            walk.pending += len(subfolders) - 1
+            finished = walk.pending == 0
+
+        for folder, folder_path in subfolders:
+            user_queue.put((priority, next(sequence), _FOLDER_TASK, (walk, folder.id, folder_path, depth + 1)))
+
+        if finished:
+            if walk.drive_client:
+                walk.drive_client.close()
+            files = walk.files
+            if walk.failed:
+                # A partial drive is left out of the report and drive sizes, as an unlisted drive would be.
+                logger.error("Audit of user drive %s is incomplete, a folder failed to list after %i files were found.",
+                             walk.user.primaryEmail, len(walk.files))
+                files = None
+            self._record_user_audit(walk.user, files, time.time() - walk.started, walk.estimated_size)
+
+    def scan_user(self, user, estimated_size=None):
+        """
+        Risk scan a single user's drive.
+        """
+        started = time.time()
+        files = self.list_exposed_user_files(user)
+        self._record_user_audit(user, files, time.time() - started, estimated_size)
 
-        if not users:
+    def _record_user_audit(self, user, files, seconds, estimated_size):
+        """
+        Keep the files and audit stats of a completed user drive.
+        """
+        with self._user_files_lock:
+            self.user_audit_stats[user.primaryEmail] = dict(files=len(files) if files is not None else None,
+                                                            seconds=seconds,
+                                                            estimate=estimated_size)
+        if files is None:
+            logger.error("Audit of user drive %s failed, no files recorded.", user.primaryEmail)
             return
 
-        for user in users:
-            if not user.primaryEmail:
-                continue
-            files = self.list_user_drive(user)
-            if not files:
-                logger.info("No files found in user drive %s.", user.primaryEmail)
-                continue
+        if not files:
+            logger.info("No files found in user drive %s.", user.primaryEmail)
+            return
 
-            logger.info("Completed audit of user drive %s. %i files found.", user.primaryEmail, len(files))
+        logger.info("Completed audit of user drive %s. %i files found in %.1fs (estimated %s).",
+                    user.primaryEmail, len(files), seconds, estimated_size)
+        with self._user_files_lock:
             self.user_files[user.primaryEmail] = files
 
-    def list_user_drive(self, user):
+    def probe_drive_size(self, user):
+        """
+        Estimate the size of a user's drive from a single page of file ids.
+        :return: estimated file count (None if the probe fails).
+        """
+        drive_client = None
+        size = None
+        try:
+            drive_client = GoogleDriveClient(self.credentials,
+                                             connect_as=user.primaryEmail)
+            size = drive_client.estimate_file_count()
+        except:
+            logger.exception("Error occurred probing drive size for user %s.", user.primaryEmail)
+        finally:
+            if drive_client:
+                drive_client.close()
+        return size
+
+    def load_drive_sizes(self):
+        """
+        Load per-user drive file counts recorded by a previous run.
+        :return: dictionary of user email to file count.
+        """
+        if not self.drive_size_file or not os.path.exists(self.drive_size_file):
+            return dict()
+        try:
+            f = open(self.drive_size_file, "rb")
+            drive_sizes = json.loads(f.read().decode('utf-8'))
+            f.close()
+        except:
+            logger.exception("Error occurred loading drive sizes from '%s'.", self.drive_size_file)
+            return dict()
+        return drive_sizes
+
+    def save_drive_sizes(self, drive_sizes):
+        """
+        Record per-user drive file counts for scheduling the next run.
+        """
+        if not self.drive_size_file:
+            return
+        try:
+            f = open(self.drive_size_file, "wb")
+            f.write(json.dumps(drive_sizes).encode('utf-8'))
+            f.close()
+        except:
+            logger.exception("Error occurred saving drive sizes to '%s'.", self.drive_size_file)
+
+    def log_user_audit_stats(self, elapsed, top=10):
         """
-        Connect as the specified user and get report on all files.
+        Log the time and size spent on each of the slowest user drives.
+        """
+        if not self.user_audit_stats:
+            return
+        slowest = sorted(self.user_audit_stats.iteritems(), key=lambda item: item[1]["seconds"], reverse=True)
+        total_seconds = sum(stats["seconds"] for _, stats in slowest)
+        failed = sum(1 for _, stats in slowest if stats["files"] is None)
+        logger.info("Audited %i user drives (%i failed) in %.1fs (%.1fs of drive walks, longest single drive %.1fs).",
+                    len(slowest), failed, elapsed, total_seconds, slowest[0][1]["seconds"])
+        for email, stats in slowest[:top]:
+            logger.info("User drive %s: %s files in %.1fs (estimated %s).",
+                        email, stats["files"], stats["seconds"], stats["estimate"])
+
+    def list_exposed_user_files(self, user):
+        """
+        Connect as the specified user and get report on exposed files.
         """
         drive_client = None
         files = None
         try:
             drive_client = GoogleDriveClient(self.credentials,
                                              connect_as=user.primaryEmail)
-            files = drive_client.walk_tree(exclude_folders_named=self.exclude_folders_named)
+            files = self.scan_user_drive(drive_client)
 
         except:
             logger.exception("Error occurred querying drive files for user %s.", user.primaryEmail)
@@ -154,21 +423,57 @@ class GoogleDriveAuditReport(object):
                 drive_client.close()
         return files
 
-    def get_users(self):
+    def validate_risk_scan(self):
         """
-        Call the admin api and get a list of all user objects.
+        Check the risk scan filters once before any drive is scanned.
+        A malformed query would otherwise fail for every user.
+        """
+        if not self.risk_visibility and not self.risk_shared_with:
+            raise ValueError("A risk scan needs at least one of risk_visibility or risk_shared_with.")
+        GoogleDriveClient.exposure_query(visibility=self.risk_visibility, shared_with=self.risk_shared_with)
+
+    def scan_user_drive(self, drive_client):
+        """
+        List only the exposed files in the connected user's drive, skipping folder traversal.
+        """
+        files = drive_client.exposed_files(visibility=self.risk_visibility,
+                                           shared_with=self.risk_shared_with,
+                                           after=self.modified_after,
+                                           before=self.modified_before)
+        if not self.exclude_folders_named:
+            return files
+
+        # No folders are walked, so drop files resolved beneath excluded folders instead.
+        excluded = set(self.exclude_folders_named)
+        return [[path, f] for path, f in files if not excluded.intersection(path.split("/"))]
+
+    def user_pages(self):
+        """
+        Call the admin api and generate pages of user objects as they are retrieved.
         :return:
         """
         admin_client = None
-        users = None
+        self.user_listing_failed = False
         try:
             admin_client = GoogleAdminClient(self.credentials, connect_as=self.admin_user)
-            users = admin_client.all_users()
+            for users in admin_client.user_pages(exclude_suspended=self.exclude_suspended_users,
+                                                 exclude_archived=self.exclude_archived_users):
+                yield users
         except:
             logger.exception("Error occurred querying google users.")
+            self.user_listing_failed = True
         finally:
             if admin_client:
                 admin_client.close()
+
+    def get_users(self):
+        """
+        Call the admin api and get a list of all user objects.
+        :return:
+        """
+        users = []
+        for page in self.user_pages():
+            users.extend(page)
         return users
 
     def export_user_drive_report(self, output_file_name=None):
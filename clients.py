@@ -2,11 +2,15 @@ from external.types import NamedTupleFactory
 import json
 import os
 import random
+import threading
+from Queue import LifoQueue, Empty
 from googleapiclient.errors import HttpError
 from googleapiclient.discovery import build
+from googleapiclient.http import build_http
 from external.timeutils import iso_strptime
 from google.oauth2 import service_account
-from httplib2 import HttpLib2Error
+from google_auth_httplib2 import AuthorizedHttp
+from httplib2 import HttpLib2Error, iri2uri, urlnorm
 from time import sleep
 import logging
 logger = logging.getLogger(__name__)
@@ -39,6 +43,80 @@ class RetryCountExceeded(Exception):
     pass
 
 
+class PooledHttp(object):
+    """
+    Thread safe stand in for httplib2.Http, shared by all api clients.
+
+    httplib2.Http objects are not thread safe, so each request borrows one from a pool and returns it
+    when the response has been read. Pooled Http objects keep their keep-alive connections open,
+    so connections to googleapis.com are reused across clients, users and threads.
+    """
+
+    def __init__(self, pool_size=10, http_factory=build_http):
+        """
+        :param pool_size: max number of Http objects (and so concurrent requests).
+        :param http_factory: function returning a new httplib2.Http object.
+        """
+        self.pool_size = pool_size
+        self.http_factory = http_factory
+        # Last in first out so requests go to the most recently used connections, which are most likely to be open.
+        self._pool = LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        # Connection stats.
+        self.requests = 0
+        self.reused_connections = 0
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.pool_size:
+                # Only count the slot once the Http object exists, so a failing factory doesn't shrink the pool.
+                http = self.http_factory()
+                self._created += 1
+                return http
+
+        # Pool is exhausted, wait for an Http object to be returned.
+        return self._pool.get()
+
+    def request(self, uri, *args, **kwargs):
+        """
+        Perform a request with a pooled Http object, see httplib2.Http.request
+        """
+        http = self._acquire()
+        try:
+            # Keyed the same way as httplib2's own connection cache.
+            scheme, authority = urlnorm(iri2uri(uri))[:2]
+            connection = http.connections.get(scheme + ":" + authority)
+            reused = connection is not None and connection.sock is not None
+            with self._lock:
+                self.requests += 1
+                if reused:
+                    self.reused_connections += 1
+            return http.request(uri, *args, **kwargs)
+        finally:
+            self._pool.put(http)
+
+    @property
+    def connection_stats(self):
+        """
+        :return: dictionary of request, reused connection and pooled Http object counts.
+        """
+        with self._lock:
+            return dict(requests=self.requests,
+                        reused_connections=self.reused_connections,
+                        new_connections=self.requests - self.reused_connections,
+                        pooled=self._created)
+
+
+# Transport shared by all api clients, set pool_size before connecting clients to change it.
+default_http_pool = PooledHttp()
+
+
 def execute_request(request, retry_count=0):
     try:
         return request.execute()
@@ -73,8 +151,12 @@ class GoogleAdminClient(object):
                                                   encoders={"users": gadmin_user})
     gdrive_user_reference = NamedTupleFactory("GDriveUserReference",
                                               ["kind", "displayName", "me", "permissionId", "emailAddress"])
+    # Partial response field mask for user listings, only what the audit needs.
+    user_list_fields = "nextPageToken,users(primaryEmail,suspended,archived)"
     default_user_account = None
     credentials = None
+    # Transport shared by all clients (requests are authorized per client).
+    http_pool = default_http_pool
 
     def __init__(self, credentials, connect_as=None, authorization_scope=None):
         """
@@ -140,11 +222,9 @@ class GoogleAdminClient(object):
         credentials = service_account.Credentials.from_service_account_file(
             self.credential_path, scopes=self.authorization_scope)
 
-        if not self.proxy_user:
-            self.client = build('admin', 'directory_v1', credentials=credentials)
-            return
-
-        self.client = build('admin', 'directory_v1', credentials=(credentials.with_subject(self.proxy_user)))
+        if self.proxy_user:
+            credentials = credentials.with_subject(self.proxy_user)
+        self.client = build('admin', 'directory_v1', http=AuthorizedHttp(credentials, http=self.http_pool))
 
     def load_credentials(self, connect_as):
         """
@@ -166,33 +246,47 @@ class GoogleAdminClient(object):
         f.write(json.dumps(self.credentials).encode('utf-8'))
         f.close()
 
-    def all_users(self, page_token=None, previous_pages=None):
+    def user_pages(self, max_results=500, fields=None, exclude_suspended=False, exclude_archived=False):
         """
-        Get all uses associated with the current customer account.
-        :param page_token:
-        :param previous_pages:
-        :return:
+        Generate pages of users associated with the current customer account.
+        Each page is yielded as soon as it is retrieved so callers can start work on it
+        while the rest of the directory is still being listed.
+
+        :param max_results: users per page (500 is the directory api maximum).
+        :param fields: partial response field mask (defaults to user_list_fields, use "*" for full user resources).
+        :param exclude_suspended: filter out suspended accounts server side.
+        :param exclude_archived: filter out archived accounts.
+        :return: generator of lists of gadmin_user objects
         """
         # Specify all users for the customer ID associated with credentials.
-        params = dict(customer="my_customer")
-        if page_token:
+        params = dict(customer="my_customer", maxResults=max_results, fields=fields or self.user_list_fields)
+        if exclude_suspended:
+            params["query"] = "isSuspended=false"
+
+        while True:
+            request = self.client.users().list(**params)
+            user_list_response = self.gadmin_user_list_response.from_python(self._execute_request(request))
+            users = user_list_response.users or []
+            if exclude_archived:
+                # Archived state is not searchable in the directory api, drop these from the page instead.
+                users = [u for u in users if not u.archived]
+            yield users
+
+            if not user_list_response.nextPageToken:
+                return
             # Continue a previously run paginated query result.
-            params["pageToken"] = page_token
-
-        request = self.client.users().list(**params)
-        user_list_response = self.gadmin_user_list_response.from_python(self._execute_request(request))
-        all_files = user_list_response.users or []
-
-        if previous_pages:
-            # Combine current and previous pages of results.
-            all_files = previous_pages + all_files
+            params["pageToken"] = user_list_response.nextPageToken
 
-        if user_list_response.nextPageToken:
-            # More pages available, recurse and fetch next page.
-            return self.all_users(page_token=user_list_response.nextPageToken,
-                                  previous_pages=all_files)
-
-        return all_files
+    def all_users(self, **kwargs):
+        """
+        Get all uses associated with the current customer account.
+        :param kwargs: see user_pages
+        :return:
+        """
+        all_users = []
+        for users in self.user_pages(**kwargs):
+            all_users.extend(users)
+        return all_users
 
 
 class GoogleDriveClient(GoogleAdminClient):
@@ -227,6 +321,8 @@ class GoogleDriveClient(GoogleAdminClient):
     gdrive_file_list = NamedTupleFactory("GDriveFileList", ["files", "nextPageToken", "incompleteSearch", "kind"],
                                          encoders={"files": gdrive_file})
     folder_mime_type = 'application/vnd.google-apps.folder'
+    # Values accepted by the files query visibility term.
+    visibility_values = ("anyoneCanFind", "anyoneWithLink", "domainCanFind", "domainWithLink", "limited")
     gdrive_restrictions = NamedTupleFactory("GDriveRestrictions",
                                             ["adminManagedRestrictions", "copyRequiresWriterPermission",
                                              "domainUsersOnly", "teamMembersOnly"])
@@ -250,10 +346,9 @@ class GoogleDriveClient(GoogleAdminClient):
                                    ['https://www.googleapis.com/auth/drive.readonly']
         credentials = service_account.Credentials.from_service_account_file(
             self.credential_path, scopes=self.authorization_scope)
-        if not self.proxy_user:
-            self.client = build('drive', 'v3', credentials=credentials)
-            return
-        self.client = build('drive', 'v3', credentials=(credentials.with_subject(self.proxy_user)))
+        if self.proxy_user:
+            credentials = credentials.with_subject(self.proxy_user)
+        self.client = build('drive', 'v3', http=AuthorizedHttp(credentials, http=self.http_pool))
 
     def walk_tree(self, folder_id='root', path=None, depth=0, max_depth=20, my_folders_only=True,
                   exclude_folders_named=None):
@@ -268,8 +363,40 @@ class GoogleDriveClient(GoogleAdminClient):
         :param exclude_folders_named: list of folder names which should be skipped if encountered.
         :return:
         """
+        all_files, subfolders = self.list_folder(folder_id=folder_id, path=path, depth=depth, max_depth=max_depth,
+                                                 my_folders_only=my_folders_only,
+                                                 exclude_folders_named=exclude_folders_named)
+        for folder, folder_path in subfolders:
+            file_entries = self.walk_tree(folder_id=folder.id,
+                                          depth=depth + 1,
+                                          path=folder_path,
+                                          max_depth=max_depth,
+                                          exclude_folders_named=exclude_folders_named)
+            if not file_entries:
+                continue
+
+            all_files.extend(file_entries)
+
+        return all_files
+
+    def list_folder(self, folder_id='root', path=None, depth=0, max_depth=20, my_folders_only=True,
+                    exclude_folders_named=None, strict=False):
+        """
+        List a single folder, separating its files from the subfolders which should be walked next.
+        Allows a folder hierarchy to be walked one folder at a time (see walk_tree).
+
+        :param folder_id: ID of folder to list.
+        :param path: name of current folder
+        :param depth: current depth
+        :param max_depth: max depth to descend (prevents infinite loops)
+        :param my_folders_only: only walk folders that I own
+        :param exclude_folders_named: list of folder names which should be skipped if encountered.
+        :param strict: raise request errors instead of returning a partial listing
+        :return: tuple of a list of [path, gdrive_file] pairs and a list of (gdrive_file, path) subfolder pairs.
+        """
         all_files = []
         folders = []
+        subfolders = []
         if exclude_folders_named and not isinstance(exclude_folders_named, (list, tuple, set)):
             raise ValueError("Parameter exclude_folders_named must be a list, tuple or set type containing "
                              "folder names to exclude.")
@@ -280,9 +407,9 @@ class GoogleDriveClient(GoogleAdminClient):
 
         logger.info("Walking folder hierarchy %s: %s.", self.proxy_user, path)
 
-        file_entries = self.files(folder_id=folder_id)
+        file_entries = self.files(folder_id=folder_id, strict=strict)
         if not file_entries:
-            return all_files
+            return all_files, subfolders
 
         for fe in file_entries:
             if fe.mimeType == self.folder_mime_type:
@@ -312,19 +439,12 @@ class GoogleDriveClient(GoogleAdminClient):
                 logger.warning("Max depth exceeded while auditing gdrive for %s.", self.proxy_user)
                 continue
 
-            file_entries = self.walk_tree(folder_id=folder.id,
-                                          depth=depth + 1,
-                                          path=path + "/" + folder.name,
-                                          max_depth=max_depth,
-                                          exclude_folders_named=exclude_folders_named)
-            if not file_entries:
-                continue
+            subfolders.append((folder, path + "/" + folder.name))
 
-            all_files.extend(file_entries)
+        return all_files, subfolders
 
-        return all_files
-
-    def files(self, folder_id=None, after=None, before=None, page_token=None, previous_pages=None):
+    def files(self, folder_id=None, after=None, before=None, visibility=None, shared_with=None, strict=False,
+              page_size=1000):
         """
         Get all files matching the search parameters.
 
@@ -333,61 +453,172 @@ class GoogleDriveClient(GoogleAdminClient):
         :param folder_id: just files in this folder (if blank, files owned by current proxy user will be returned)
         :param after: (optional) beginning last modified date range
         :param before: (optional) ending last modified date range
-        :param page_token: leave empty - only used when recursing paged results
-        :param previous_pages: leave empty - only used when recursing paged results
+        :param visibility: (optional) visibility value or list of values e.g. anyoneWithLink, anyoneCanFind
+        :param shared_with: (optional) list of user or group emails the files must be shared with
+        :param strict: raise request errors instead of returning the files listed so far
+        :param page_size: files per page (1000 is the drive api maximum)
         :return: an array of gdrive_file_reference objects found in the described folder
         """
         # Primary operation here is to list all files and folders visible to the specified user.
-        if not page_token:
-            q = "trashed = false"
-            if after:
-                # Add a beginning date range to the query.
-                q = "modifiedTime > '{after}' and {q}".format(q=q, after=after.isoformat())
-            if before:
-                # Add an ending date range to the query.
-                q = "modifiedTime < '{before}' and {q}".format(q=q, before=before.isoformat())
-
-            if folder_id:
-                # Restrict files to the following containing folder(s).
-                if isinstance(folder_id, basestring):
-                    q = "'{folder_id}' in parents and {q}".format(folder_id=folder_id, q=q)
-                elif isinstance(folder_id, (list, tuple)):
-                    q = "(" + \
-                        " or ".join("'{folder_id}' in parents".format(folder_id=f) for f in folder_id) + \
-                        ") and {q}".format(q=q)
-                params = dict(includeTeamDriveItems=True, supportsTeamDrives=True,
-                              fields="files,nextPageToken,incompleteSearch,kind", q=q)
-            else:
-                # Restrict files by owner.
-                q = "'{owner}' in owners and {q}".format(owner=self.proxy_user, q=q)
-                params = dict(includeTeamDriveItems=False, supportsTeamDrives=False,
-                              fields="files,nextPageToken,incompleteSearch,kind", q=q)
-
+        q = "trashed = false"
+        if after:
+            # Add a beginning date range to the query.
+            q = "modifiedTime > '{after}' and {q}".format(q=q, after=after.isoformat())
+        if before:
+            # Add an ending date range to the query.
+            q = "modifiedTime < '{before}' and {q}".format(q=q, before=before.isoformat())
+
+        exposure = self.exposure_query(visibility=visibility, shared_with=shared_with)
+        if exposure:
+            # Only files exposed in any of the described ways.
+            q = "{exposure} and {q}".format(exposure=exposure, q=q)
+
+        if folder_id:
+            # Restrict files to the following containing folder(s).
+            if isinstance(folder_id, basestring):
+                q = "'{folder_id}' in parents and {q}".format(folder_id=folder_id, q=q)
+            elif isinstance(folder_id, (list, tuple)):
+                q = "(" + \
+                    " or ".join("'{folder_id}' in parents".format(folder_id=f) for f in folder_id) + \
+                    ") and {q}".format(q=q)
+            params = dict(includeTeamDriveItems=True, supportsTeamDrives=True,
+                          fields="files,nextPageToken,incompleteSearch,kind", q=q)
         else:
-            # Continue a previously run paginated query result.
+            # Restrict files by owner.
+            q = "'{owner}' in owners and {q}".format(owner=self.proxy_user, q=q)
+            params = dict(includeTeamDriveItems=False, supportsTeamDrives=False,
+                          fields="files,nextPageToken,incompleteSearch,kind", q=q)
+
+        # Continue paginated query results until complete (the original query is repeated with each page token).
+        params["pageSize"] = page_size
+        all_files = []
+        while True:
+            request = self.client.files().list(**params)
+            try:
+                file_list_response = self.gdrive_file_list.from_python(self._execute_request(request))
+            except BackendConfigurationError:
+                logger.exception("An error occurred while listing gdrive files.")
+                if strict:
+                    raise
+                return all_files
+
+            files = file_list_response.files or []
+            logger.info("List files request retrieved %s files." % len(files))
+            all_files.extend(files)
+
+            if not file_list_response.nextPageToken:
+                return all_files
             logger.info("Paging request... ")
-            params = dict(pageToken=page_token)
+            params["pageToken"] = file_list_response.nextPageToken
 
-        request = self.client.files().list(**params)
-        try:
-            file_list_response = self.gdrive_file_list.from_python(self._execute_request(request))
-        except BackendConfigurationError:
-            logger.exception("An error occurred while listing gdrive files.")
-            return previous_pages or []
+    def estimate_file_count(self, page_size=1000):
+        """
+        Cheap estimate of the number of files owned by the current proxy user, from a single page of file ids.
 
-        all_files = file_list_response.files or []
-        logger.info("List files request retrieved %s files." % len(all_files))
+        :param page_size: max files to count (1000 is the drive api maximum).
+        :return: number of files found, a lower bound when more pages are available.
+        """
+        q = "'{owner}' in owners and trashed = false".format(owner=self.proxy_user)
+        request = self.client.files().list(q=q, pageSize=page_size, fields="nextPageToken,files(id)")
+        response = self._execute_request(request)
+        return len(response.get("files") or [])
+
+    @staticmethod
+    def exposure_query(visibility=None, shared_with=None):
+        """
+        Build a files query clause matching any of the described exposures.
 
-        if previous_pages:
-            # Combine current and previous pages of results.
-            all_files = previous_pages + all_files
+        :param visibility: visibility value or list of values e.g. anyoneWithLink, anyoneCanFind
+        :param shared_with: list of user or group emails with read or write access
+        :return: query clause string or None if no exposures are described.
+        """
+        if isinstance(visibility, basestring):
+            visibility = [visibility]
+        if isinstance(shared_with, basestring):
+            shared_with = [shared_with]
+
+        unknown = set(visibility or []) - set(GoogleDriveClient.visibility_values)
+        if unknown:
+            raise ValueError("Unknown visibility value(s) {}, expected any of {}.".format(
+                ", ".join(sorted(unknown)), ", ".join(GoogleDriveClient.visibility_values)))
+
+        clauses = ["visibility = '{}'".format(v) for v in visibility or []]
+        for email in shared_with or []:
+            # Quotes and backslashes must be escaped within query string values.
+            email = email.replace("\\", "\\\\").replace("'", "\\'")
+            clauses.append("'{email}' in readers or '{email}' in writers".format(email=email))
+        if not clauses:
+            return None
+        return "(" + " or ".join(clauses) + ")"
 
-        if file_list_response.incompleteSearch:
-            # More pages available, recurse and fetch next page.
-            return self.files(page_token=file_list_response.nextPageToken,
-                              previous_pages=all_files)
+    def exposed_files(self, visibility=None, shared_with=None, after=None, before=None):
+        """
+        Get files owned by the current proxy user which match the exposure filters, without walking the folder tree.
+        Paths are resolved only for the parent folders of matching files.
+
+        :param visibility: visibility value or list of values e.g. anyoneWithLink, anyoneCanFind
+        :param shared_with: list of user or group emails the files must be shared with
+        :param after: (optional) beginning last modified date range
+        :param before: (optional) ending last modified date range
+        :return: list of [path, gdrive_file] pairs (same shape as walk_tree)
+        """
+        if not visibility and not shared_with:
+            raise ValueError("At least one of visibility or shared_with must be supplied.")
+
+        logger.info("Scanning exposed files for %s.", self.proxy_user)
+        # An empty result must mean nothing is exposed, so query errors are raised rather than hidden.
+        file_entries = self.files(visibility=visibility, shared_with=shared_with, after=after, before=before,
+                                  strict=True)
+        folder_paths = {}
+        all_files = []
+        for fe in file_entries:
+            parent_id = fe.parents[0] if fe.parents else None
+            path = self.folder_path(parent_id, folder_paths) if parent_id else "root"
+            all_files.append([path, fe])
         return all_files
 
+    def folder_path(self, folder_id, folder_paths, depth=0, max_depth=20):
+        """
+        Resolve the path of a folder by walking up its parents.
+
+        :param folder_id: ID of folder to resolve.
+        :param folder_paths: dictionary of already resolved folder ids to paths (updated in place).
+        :param depth: current depth (used in recursion)
+        :param max_depth: max depth to ascend (prevents infinite loops)
+        :return: path string in the format produced by walk_tree e.g. root/Folder/Subfolder
+        """
+        if not folder_paths:
+            # Seed the cache with the proxy user's own root folder.
+            folder_paths["root"] = "root"
+            try:
+                root = self._execute_request(self.client.files().get(fileId='root', fields="id"))
+                folder_paths[root["id"]] = "root"
+            except BackendConfigurationError:
+                logger.exception("Failed to retrieve root folder for %s.", self.proxy_user)
+
+        if folder_id in folder_paths:
+            return folder_paths[folder_id]
+
+        if depth >= max_depth:
+            logger.warning("Max depth exceeded while resolving gdrive path for %s.", self.proxy_user)
+            return folder_id
+
+        try:
+            request = self.client.files().get(fileId=folder_id, fields="id,name,parents", supportsTeamDrives=True)
+            folder = self.gdrive_file.from_python(self._execute_request(request))
+        except BackendConfigurationError:
+            # Folder isn't visible to this user, use its id as the path (as walk_tree does for a starting folder).
+            folder_paths[folder_id] = folder_id
+            return folder_id
+
+        if folder.parents:
+            path = self.folder_path(folder.parents[0], folder_paths, depth=depth + 1, max_depth=max_depth) + \
+                "/" + folder.name
+        else:
+            path = folder.name
+        folder_paths[folder_id] = path
+        return path
+
     def team_drives(self, page_token=None, previous_pages=None):
         """
         Get a list of all team drives in the account.
@@ -5,6 +5,12 @@ import json
 from external.timeutils import iso_strptime, iso_utcz_strftime
 import datetime
 import pytz
+import os
+import tempfile
+import threading
+import audit
+from clients import GoogleAdminClient, GoogleDriveClient, PooledHttp, RetryCountExceeded, \
+    BackendConfigurationError
 
 
 class NamedTupleFactoryTest(TestCase):
@@ -84,3 +90,395 @@ class NamedTupleFactoryTest(TestCase):
         self.assertEqual(serializable.f, 2)
         self.assertEqual(serializable.complex.e, 1)
         self.assertEqual(serializable.complex.t, "2019-02-26T00:00:01Z")
+
+
+class FakeRequest(object):
+
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class FakeUsersResource(object):
+    """
+    Users resource returning pages of users in turn and recording the list params of each request.
+    """
+
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.requests = []
+
+    def users(self):
+        return self
+
+    def list(self, **params):
+        self.requests.append(params)
+        users, next_page_token = self.pages[len(self.requests) - 1]
+        return FakeRequest({"users": users, "nextPageToken": next_page_token})
+
+
+class UserPagesTest(TestCase):
+
+    def setUp(self):
+        super(UserPagesTest, self).setUp()
+        # Skip connecting, requests go to the fake users resource.
+        self.admin_client = GoogleAdminClient.__new__(GoogleAdminClient)
+        self.admin_client.credential_path = "credentials.json"
+        self.admin_client.client = FakeUsersResource([
+            ([{"primaryEmail": "a@x.com"}, {"primaryEmail": "b@x.com", "archived": True}], "page-2"),
+            ([{"primaryEmail": "c@x.com"}], None),
+        ])
+
+    def test_that_users_are_listed_in_pages_of_500_with_a_field_mask(self):
+        list(self.admin_client.user_pages())
+        first, second = self.admin_client.client.requests
+        self.assertEqual(first, {"customer": "my_customer", "maxResults": 500,
+                                 "fields": "nextPageToken,users(primaryEmail,suspended,archived)"})
+        self.assertEqual(second, dict(first, pageToken="page-2"))
+
+    def test_that_each_page_is_yielded_before_the_next_is_requested(self):
+        pages = self.admin_client.user_pages()
+        self.assertEqual([u.primaryEmail for u in next(pages)], ["a@x.com", "b@x.com"])
+        self.assertEqual(len(self.admin_client.client.requests), 1)
+        self.assertEqual([u.primaryEmail for u in next(pages)], ["c@x.com"])
+        self.assertEqual(len(self.admin_client.client.requests), 2)
+        self.assertEqual(list(pages), [])
+
+    def test_that_suspended_users_are_filtered_by_query_and_archived_users_by_page(self):
+        pages = list(self.admin_client.user_pages(exclude_suspended=True, exclude_archived=True))
+        self.assertEqual([[u.primaryEmail for u in page] for page in pages], [["a@x.com"], ["c@x.com"]])
+        for params in self.admin_client.client.requests:
+            self.assertEqual(params["query"], "isSuspended=false")
+
+
+class ExposureQueryTest(TestCase):
+
+    def test_that_no_exposures_produce_no_query(self):
+        self.assertIsNone(GoogleDriveClient.exposure_query())
+
+    def test_that_visibility_values_are_combined(self):
+        q = GoogleDriveClient.exposure_query(visibility=["anyoneWithLink", "anyoneCanFind"])
+        self.assertEqual(q, "(visibility = 'anyoneWithLink' or visibility = 'anyoneCanFind')")
+
+    def test_that_shared_with_principals_are_combined_with_visibility(self):
+        q = GoogleDriveClient.exposure_query(visibility="anyoneWithLink", shared_with=["a@partner.com"])
+        self.assertEqual(q, "(visibility = 'anyoneWithLink' or "
+                            "'a@partner.com' in readers or 'a@partner.com' in writers)")
+
+
+    def test_that_unknown_visibility_values_are_rejected(self):
+        with self.assertRaises(ValueError):
+            GoogleDriveClient.exposure_query(visibility=["anyoneWithlink"])
+
+    def test_that_shared_with_emails_are_escaped(self):
+        q = GoogleDriveClient.exposure_query(shared_with=["o'brien@partner.com"])
+        self.assertEqual(q, "('o\\'brien@partner.com' in readers or 'o\\'brien@partner.com' in writers)")
+
+
+class FakeFilesResource(object):
+    """
+    Files resource returning a number of single file pages and recording the list params of each request.
+    """
+
+    def __init__(self, page_count):
+        self.page_count = page_count
+        self.requests = []
+
+    def files(self):
+        return self
+
+    def list(self, **params):
+        self.requests.append(dict(params))
+        page = len(self.requests)
+        next_page_token = "page-%i" % (page + 1) if page < self.page_count else None
+        return FakeRequest({"files": [{"id": str(page)}], "nextPageToken": next_page_token})
+
+
+class FilesPagingTest(TestCase):
+
+    def setUp(self):
+        super(FilesPagingTest, self).setUp()
+        # Skip connecting, requests go to the fake files resource.
+        self.client = GoogleDriveClient.__new__(GoogleDriveClient)
+        self.client.credential_path = "credentials.json"
+        self.client.proxy_user = "u@x.com"
+        self.client.client = FakeFilesResource(1200)
+
+    def test_that_many_pages_are_listed_without_recursion(self):
+        files = self.client.files()
+        self.assertEqual(len(files), 1200)
+        self.assertEqual(files[-1].id, "1200")
+
+    def test_that_each_page_repeats_the_query_with_the_next_page_token(self):
+        self.client.files()
+        first, second = self.client.client.requests[:2]
+        self.assertEqual(first["pageSize"], 1000)
+        self.assertNotIn("pageToken", first)
+        self.assertEqual(second, dict(first, pageToken="page-2"))
+
+
+def gdrive_entry(name, folder=False, mine=True):
+    return GoogleDriveClient.gdrive_file.from_python({
+        "id": name, "name": name,
+        "mimeType": GoogleDriveClient.folder_mime_type if folder else "text/plain",
+        "owners": [{"me": mine}]})
+
+
+class ListFolderTest(TestCase):
+
+    def setUp(self):
+        super(ListFolderTest, self).setUp()
+        # Skip connecting, only files() is needed.
+        self.client = GoogleDriveClient.__new__(GoogleDriveClient)
+        self.client.proxy_user = "u@x.com"
+        self.entries = [gdrive_entry("a.txt"), gdrive_entry("docs", folder=True),
+                        gdrive_entry(".git", folder=True), gdrive_entry("theirs", folder=True, mine=False)]
+        self.client.files = lambda folder_id=None, strict=False: self.entries
+
+    def test_that_files_and_subfolders_are_separated(self):
+        files, subfolders = self.client.list_folder(path="root/x", exclude_folders_named=[".git"])
+        self.assertEqual([(path, f.name) for path, f in files], [("root/x", "a.txt")])
+        self.assertEqual([(f.name, path) for f, path in subfolders], [("docs", "root/x/docs")])
+
+    def test_that_subfolders_are_not_walked_past_max_depth(self):
+        files, subfolders = self.client.list_folder(depth=2, max_depth=2)
+        self.assertEqual(len(files), 1)
+        self.assertEqual(subfolders, [])
+
+
+class FakeDriveClient(object):
+    """
+    Drive client listing folders from a tree of {folder id: [entry names]}, using the real list_folder.
+    Folder ids in failing_folders raise a transport error when listed,
+    folder ids in forbidden_folders fail like an api error response.
+    Root folder listings and size probes are recorded in walked, in order.
+    """
+    http_pool = PooledHttp()
+    folder_mime_type = GoogleDriveClient.folder_mime_type
+    list_folder = GoogleDriveClient.list_folder.im_func
+    trees = {}
+    failing_folders = set()
+    forbidden_folders = set()
+    connections = 0
+    walked = []
+
+    def __init__(self, credentials, connect_as=None):
+        FakeDriveClient.connections += 1
+        self.proxy_user = connect_as
+        self.user = connect_as
+        self.tree = self.trees[connect_as]
+        self.closed = False
+
+    def estimate_file_count(self):
+        self.walked.append("probe:" + self.user)
+        return sum(len(entries) for entries in self.tree.itervalues())
+
+    def files(self, folder_id=None, strict=False):
+        if folder_id == 'root':
+            self.walked.append(self.user)
+        if folder_id in self.failing_folders:
+            raise RetryCountExceeded("Request failed after retry count exceeded")
+        if folder_id in self.forbidden_folders:
+            # As GoogleDriveClient.files handles an HttpError.
+            if strict:
+                raise BackendConfigurationError("Rate limit exceeded")
+            return []
+        return [gdrive_entry(name, folder=name in self.tree) for name in self.tree.get(folder_id, [])]
+
+    def close(self):
+        self.closed = True
+
+
+class FolderTaskAuditTest(TestCase):
+
+    def setUp(self):
+        super(FolderTaskAuditTest, self).setUp()
+        self.drive_client_class = audit.GoogleDriveClient
+        audit.GoogleDriveClient = FakeDriveClient
+        FakeDriveClient.connections = 0
+        FakeDriveClient.failing_folders = set()
+        FakeDriveClient.forbidden_folders = set()
+        FakeDriveClient.trees = {
+            "big@x.com": {"root": ["r.txt", "a", "b"], "a": ["a1.txt", "a2.txt", "c"], "b": ["b1.txt"],
+                          "c": ["c1.txt", "c2.txt"]},
+            "small@x.com": {"root": ["s.txt"]},
+        }
+        users = [audit.GoogleAdminClient.gadmin_user.from_python({"primaryEmail": email})
+                 for email in sorted(FakeDriveClient.trees)]
+        fd, self.size_file = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.size_file)
+
+        self.report = audit.GoogleDriveAuditReport('{}', 'admin@x.com')
+        self.report.drive_size_file = self.size_file
+        self.report.user_pages = lambda: iter([users])
+
+    def tearDown(self):
+        super(FolderTaskAuditTest, self).tearDown()
+        audit.GoogleDriveClient = self.drive_client_class
+        if os.path.exists(self.size_file):
+            os.remove(self.size_file)
+
+    def test_that_folder_tasks_are_reassembled_per_user(self):
+        self.report.audit_users()
+        big = sorted((path, f.name) for path, f in self.report.user_files["big@x.com"])
+        self.assertEqual(big, [("root", "r.txt"), ("root/a", "a1.txt"), ("root/a", "a2.txt"),
+                               ("root/a/c", "c1.txt"), ("root/a/c", "c2.txt"), ("root/b", "b1.txt")])
+        self.assertEqual(len(self.report.user_files["small@x.com"]), 1)
+        self.assertEqual(self.report.load_drive_sizes(), {"big@x.com": 6, "small@x.com": 1})
+        # One client per user drive, however many workers walked it.
+        self.assertEqual(FakeDriveClient.connections, 2)
+
+    def test_that_a_failed_folder_drops_the_user_drive(self):
+        FakeDriveClient.failing_folders = {"c"}
+        self.report.audit_users()
+        self.assertNotIn("big@x.com", self.report.user_files)
+        self.assertIsNone(self.report.user_audit_stats["big@x.com"]["files"])
+        self.assertIn("small@x.com", self.report.user_files)
+        self.assertEqual(self.report.load_drive_sizes(), {"small@x.com": 1})
+
+    def test_that_the_shared_http_pool_size_is_left_to_the_caller(self):
+        self.report.worker_count = 20
+        self.report.audit_users()
+        self.assertEqual(FakeDriveClient.http_pool.pool_size, 10)
+
+    def test_that_a_folder_api_error_drops_the_user_drive(self):
+        FakeDriveClient.forbidden_folders = {"c"}
+        self.report.audit_users()
+        self.assertNotIn("big@x.com", self.report.user_files)
+        self.assertIsNone(self.report.user_audit_stats["big@x.com"]["files"])
+        self.assertEqual(self.report.load_drive_sizes(), {"small@x.com": 1})
+
+
+class DriveScheduleTest(TestCase):
+
+    def setUp(self):
+        super(DriveScheduleTest, self).setUp()
+        self.drive_client_class = audit.GoogleDriveClient
+        audit.GoogleDriveClient = FakeDriveClient
+        FakeDriveClient.failing_folders = set()
+        FakeDriveClient.forbidden_folders = set()
+        FakeDriveClient.walked = []
+        FakeDriveClient.trees = {
+            "gate@x.com": {"root": []},
+            "small@x.com": {"root": ["s1.txt"]},
+            "big@x.com": {"root": ["b%i.txt" % i for i in xrange(5)]},
+            "new-big@x.com": {"root": ["n%i.txt" % i for i in xrange(50)]},
+            "new-small@x.com": {"root": ["m1.txt"]},
+        }
+        fd, self.size_file = tempfile.mkstemp()
+        os.close(fd)
+        f = open(self.size_file, "wb")
+        f.write(json.dumps({"small@x.com": 10, "big@x.com": 100}).encode('utf-8'))
+        f.close()
+
+        def user(email):
+            return audit.GoogleAdminClient.gadmin_user.from_python({"primaryEmail": email})
+
+        gate_started = threading.Event()
+        gate_released = threading.Event()
+        original_list_folder = FakeDriveClient.list_folder
+
+        def list_folder(client, folder_id='root', **kwargs):
+            if client.user == "gate@x.com":
+                # Hold the only worker until every other user has been queued.
+                gate_started.set()
+                gate_released.wait(5)
+            return original_list_folder(client, folder_id=folder_id, **kwargs)
+
+        def user_pages():
+            yield [user("gate@x.com")]
+            gate_started.wait(5)
+            yield [user(email) for email in ("new-small@x.com", "small@x.com", "new-big@x.com", "big@x.com")]
+            gate_released.set()
+
+        FakeDriveClient.list_folder = list_folder
+        self.original_list_folder = original_list_folder
+        self.report = audit.GoogleDriveAuditReport('{}', 'admin@x.com')
+        self.report.worker_count = 1
+        self.report.drive_size_file = self.size_file
+        self.report.user_pages = user_pages
+
+    def tearDown(self):
+        super(DriveScheduleTest, self).tearDown()
+        FakeDriveClient.list_folder = self.original_list_folder
+        audit.GoogleDriveClient = self.drive_client_class
+        os.remove(self.size_file)
+
+    def test_that_larger_recorded_drives_are_walked_first_and_unknown_sizes_last(self):
+        self.report.audit_users()
+        self.assertEqual(FakeDriveClient.walked, ["gate@x.com", "big@x.com", "small@x.com",
+                                                  "new-small@x.com", "new-big@x.com"])
+        self.assertIsNone(self.report.user_audit_stats["new-big@x.com"]["estimate"])
+        self.assertEqual(self.report.user_audit_stats["big@x.com"]["estimate"], 100)
+
+    def test_that_probes_run_first_and_requeue_with_the_probed_size(self):
+        self.report.probe_unknown_drive_sizes = True
+        self.report.audit_users()
+        self.assertEqual(FakeDriveClient.walked, ["probe:gate@x.com", "gate@x.com",
+                                                  "probe:new-small@x.com", "probe:new-big@x.com",
+                                                  "big@x.com", "new-big@x.com", "small@x.com", "new-small@x.com"])
+        self.assertEqual(self.report.user_audit_stats["new-big@x.com"]["estimate"], 50)
+
+
+class FakeConnection(object):
+    sock = "open"
+
+
+class FakeHttp(object):
+
+    def __init__(self):
+        self.connections = {}
+
+    def request(self, uri, method="GET", **kwargs):
+        self.connections["https:www.googleapis.com"] = FakeConnection()
+        return {"status": "200"}, ""
+
+
+class PooledHttpTest(TestCase):
+
+    def setUp(self):
+        super(PooledHttpTest, self).setUp()
+        self.pool = PooledHttp(pool_size=2, http_factory=FakeHttp)
+
+    def test_that_connections_are_reused_between_requests(self):
+        self.pool.request("https://www.googleapis.com/drive/v3/files")
+        self.pool.request("https://www.googleapis.com/drive/v3/files")
+        stats = self.pool.connection_stats
+        self.assertEqual(stats["requests"], 2)
+        self.assertEqual(stats["reused_connections"], 1)
+        self.assertEqual(stats["new_connections"], 1)
+        self.assertEqual(stats["pooled"], 1)
+
+    def test_that_pool_size_is_not_exceeded(self):
+        first = self.pool._acquire()
+        second = self.pool._acquire()
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(self.pool._acquire()))
+        waiter.daemon = True
+        waiter.start()
+
+        # A third request waits until an Http object is returned to the pool.
+        waiter.join(0.1)
+        self.assertTrue(waiter.is_alive())
+        self.pool._pool.put(first)
+        waiter.join(1.0)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(acquired, [first])
+        self.assertIsNot(first, second)
+        self.assertEqual(self.pool.connection_stats["pooled"], 2)
+
+    def test_that_a_failing_factory_does_not_use_up_the_pool(self):
+        def failing_factory():
+            raise IOError("Failed to create http.")
+
+        self.pool.http_factory = failing_factory
+        with self.assertRaises(IOError):
+            self.pool._acquire()
+        self.assertEqual(self.pool.connection_stats["pooled"], 0)
+        self.pool.http_factory = FakeHttp
+        self.pool._acquire()
+        self.pool._acquire()
+        self.assertEqual(self.pool.connection_stats["pooled"], 2)